@@ -0,0 +1,216 @@
+"""
+Simple on-disk cache for grafana query results and rendered plots
+
+@Licence: MIT
+@Author: Boss Marco <bossm8@hotmail.com>
+"""
+
+from hashlib import sha1
+from json import dumps
+from contextlib import contextmanager
+from os import fstat, path as os_path, replace, scandir, unlink, utime
+from pathlib import Path
+from secrets import token_hex
+from shutil import copyfileobj
+from time import time
+from logging import getLogger
+
+_logger = getLogger('default')
+
+DEFAULT_CACHE_DIR = os_path.join(Path.home(), '.cache', 'grafana-dashboard-plotter')
+
+
+@contextmanager
+def open_atomic(name: str):
+    """
+    Open a file for binary writing which only replaces name once everything was written,
+    so no partial file is left behind if e.g. the connection is cut off while downloading.
+
+    :param name: The full path of the file to write
+    :return: The opened temporary file in the same directory
+    """
+
+    # Not a NamedTemporaryFile, it would be created readable for the owner only instead of honouring the umask
+    temp_name = f'{name}.{token_hex(4)}.part'
+    try:
+        with open(temp_name, 'xb') as file:
+            yield file
+        replace(temp_name, name)
+    except BaseException:
+        if os_path.exists(temp_name):
+            unlink(temp_name)
+        raise
+
+
+class ResultCache:
+    """
+    File based cache with a time to live
+
+    Each entry is stored in its own file named after the hash of its key,
+    entries older than the time to live are treated as missing.
+    """
+
+    # Bump this if the format of the cached values or keys changes to invalidate existing entries
+    schema_version = 1
+
+    def __init__(self,
+                 directory: str = DEFAULT_CACHE_DIR,
+                 ttl: int = 600,
+                 max_age: int = 86400):
+        """
+        :param directory: The directory to store the cache entries into, will be created if it does not exist
+        :param ttl: Time in seconds after which a cache entry is not used anymore
+        :param max_age: Time in seconds after which a cache entry is deleted,
+                        outdated entries are kept until then for revalidation
+        """
+
+        self.directory = directory
+        self.ttl = ttl
+        self.max_age = max_age
+        Path(self.directory).mkdir(parents=True, exist_ok=True)
+        self.__prune()
+
+    def __prune(self) -> None:
+        """
+        Delete the entries which are older than max_age, nothing else removes them from the directory
+        """
+
+        pruned = 0
+        now = time()
+        with scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file() and now - entry.stat().st_mtime >= self.max_age:
+                        unlink(entry.path)
+                        pruned += 1
+                except FileNotFoundError:
+                    # Removed by another run in the meantime
+                    continue
+        if pruned:
+            _logger.debug('Pruned %d outdated cache entries', pruned)
+
+    def key(self,
+            *parts) -> str:
+        """
+        Create a cache key from the given parts
+
+        :param parts: Json serializable values which describe the cached value
+        :return: The hash which can be used as key
+        """
+
+        return sha1(dumps([self.schema_version, *parts],
+                          sort_keys=True,
+                          default=str).encode()).hexdigest()
+
+    def __path(self,
+               key: str) -> str:
+        return os_path.join(self.directory, key)
+
+    def __open(self,
+               key: str,
+               ttl: float = None):
+        """
+        Open an entry if it is valid, the opened file stays readable even if the entry
+        is replaced or pruned by another run in the meantime.
+
+        :param key: The key of the entry, see key()
+        :param ttl: Time to live for this entry in seconds instead of the one of the cache
+        :return: The entry opened for binary reading or None if there is no valid entry
+        """
+
+        if ttl is None:
+            ttl = self.ttl
+        try:
+            entry = open(self.__path(key), 'rb')
+        except OSError:
+            return None
+        try:
+            valid = time() - fstat(entry.fileno()).st_mtime < ttl
+        except OSError:
+            valid = False
+        if not valid:
+            entry.close()
+            return None
+        _logger.debug('Cache hit for %s', key)
+        return entry
+
+    def get(self,
+            key: str,
+            ttl: float = None) -> bytes:
+        """
+        Get a cached value
+
+        :param key: The key of the entry, see key()
+        :param ttl: Time to live for this entry in seconds instead of the one of the cache
+                    (inf to get outdated entries as well)
+        :return: The cached value or None if there is no valid entry
+        """
+
+        entry = self.__open(key, ttl)
+        if entry is None:
+            return None
+        with entry:
+            try:
+                return entry.read()
+            except OSError:
+                return None
+
+    def set(self,
+            key: str,
+            value: bytes) -> None:
+        """
+        Store a value in the cache
+
+        :param key: The key of the entry, see key()
+        :param value: The value to store
+        """
+
+        # Written to a temporary file first so concurrent readers never see partial entries
+        with open_atomic(self.__path(key)) as entry:
+            entry.write(value)
+
+    def touch(self,
+              key: str) -> None:
+        """
+        Renew the time to live of an entry, e.g. if it was confirmed to be still up to date
+
+        :param key: The key of the entry, see key()
+        """
+
+        try:
+            utime(self.__path(key))
+        except FileNotFoundError:
+            # Pruned by another run in the meantime, it is stored again next time
+            pass
+
+    def copy_from(self,
+                  key: str,
+                  name: str) -> None:
+        """
+        Store the content of a file in the cache
+
+        :param key: The key of the entry, see key()
+        :param name: The full path of the file to store
+        """
+
+        with open(name, 'rb') as file, open_atomic(self.__path(key)) as entry:
+            copyfileobj(file, entry)
+
+    def copy_to(self,
+                key: str,
+                name: str) -> bool:
+        """
+        Copy a cached value directly into a file
+
+        :param key: The key of the entry, see key()
+        :param name: The full path of the file to copy the value to
+        :return: If there was a valid entry which was copied
+        """
+
+        entry = self.__open(key)
+        if entry is None:
+            return False
+        # Like the entries themselves, the file is only replaced once it was copied completely
+        with entry, open_atomic(name) as file:
+            copyfileobj(entry, file)
+        return True
@@ -6,15 +6,49 @@ Grafana Dashboard implementation to save its panels as png plots
 """
 
 import re
-from grafana_api import GrafanaClient
+from asyncio import gather
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import product
+from grafana_api import GrafanaClient, ApiError
 from slugify import slugify
 from pathlib import Path
+from time import time
 from os import path as os_path
 from re import compile
 from logging import getLogger
 
 _logger = getLogger('default')
 
+# Matches variable references in queries in the forms $var, ${var}, ${var:format} and [[var]]
+_variable_reference_regex = compile(r'\$(\w+)|\$\{(\w+)|\[\[(\w+)')
+
+
+@lru_cache(maxsize=4096)
+def _slug(text: str) -> str:
+    """
+    Cached slugify, the same variable values and titles are slugified over and over again
+    """
+
+    return slugify(text)
+
+
+def _variable_references(panel: dict) -> set:
+    """
+    Get the names of all variables referenced in the queries of a panel
+
+    :param panel: The panel json retrieved from the original dashboard json.
+    :return: The referenced variable names
+    """
+
+    # A panel can have multiple queries (targets), if one uses the variable it will be added.
+    # The referenced names are extracted, so $host does not also match $hostname
+    references = set()
+    for target in panel.get('targets', []):
+        for groups in _variable_reference_regex.findall(target.get('expr', '')):
+            references.update(name for name in groups if name)
+    return references
+
 
 class VariableError(Exception):
     pass
@@ -41,19 +75,44 @@ class Variable:
 
         self.name = name
         self.values = values
+        # The values as used in directory names
+        self.slugs = [_slug(v) for v in values]
 
     def __str__(self):
         return f'{self.name}: {self.values}'
 
 
+class RenderJob:
+    """
+    A single plot of a dashboard panel
+
+    Describes the plot independently of the directory and time range it is finally created in,
+    so the jobs of a dashboard can be planned once and plotted many times.
+    """
+
+    def __init__(self,
+                 panel: dict,
+                 params: dict,
+                 dirs: tuple):
+        """
+        :param panel: The panel json retrieved from the original dashboard json.
+        :param params: The variables used for the plot in the form of var-<VARIABLE_NAME>=<VARIABLE_VALUE>
+        :param dirs: The subdirectories the plot is placed in, named after the variable values
+        """
+
+        self.panel = panel
+        self.params = params
+        self.dirs = dirs
+
+    def __str__(self):
+        return f'{self.panel["title"]}: {self.params}'
+
+
 class Dashboard:
     """
     Grafana Dashboard
     """
 
-    # The panel of which plots are made from currently
-    current_panel: dict
-
     def __init__(self,
                  grafana_client: GrafanaClient,
                  uid: str,
@@ -61,7 +120,10 @@ class Dashboard:
                  graph_height: int = 500,
                  variables: list = None,
                  ignore_regex: str = '',
-                 render_collapsed: bool = False):
+                 render_collapsed: bool = False,
+                 concurrency: int = 8,
+                 skip_existing: bool = False,
+                 max_age: int = 0):
         """
         :param grafana_client: The client of which is connected to the grafana instance to create plots from
         :param uid: The uid of the dashboard
@@ -73,6 +135,10 @@ class Dashboard:
                           For variables which are not listed here, the default which is set in the grafana UI is used.
         :param ignore_regex: Regular expression matching values of the variable which shall be ignored.
         :param render_collapsed: If panels located inside collapsed rows should be rendered too
+        :param concurrency: How many plots of this dashboard are requested from grafana at the same time
+                            (asynchronous plots are bounded by the AsyncGrafanaClient across all dashboards)
+        :param skip_existing: If plots which already exist on disk should not be requested again
+        :param max_age: Age in seconds after which existing plots are requested again anyway, 0 means never
         """
 
         self.grafana_client = grafana_client
@@ -80,56 +146,76 @@ class Dashboard:
         self.graph_width = graph_width
         self.graph_height = graph_height
         self.render_collapsed = render_collapsed
+        self.ignore_regex = compile(ignore_regex) if ignore_regex != '' else None
+        self.concurrency = concurrency
+        self.skip_existing = skip_existing
+        self.max_age = max_age
+        # Directories which were already created for plots, to avoid redundant mkdir calls
+        self.__created_dirs = set()
+        # Set once a plot saved with save_plot aborted the dashboard
+        self.__aborted = False
 
         dash_json = self.grafana_client.get_dashboard_json(self.uid)
         self.slug = dash_json['meta']['slug']
         self.json = dash_json['dashboard']
 
-        _logger.debug(f'Dash: {self.uid} has slug `{self.slug}`')
+        _logger.debug('Dash: %s has slug `%s`', self.uid, self.slug)
 
         if variables is None:
             variables = []
         regex = compile("|".join(variables))
 
-        _logger.debug(f'Dash: {self.uid} using variable regex `{regex.pattern}`')
+        _logger.debug('Dash: %s using variable regex `%s`', self.uid, regex.pattern)
 
         variables_json = self.json['templating']['list']
         variables_json = filter(lambda v: regex.fullmatch(v['name']),
                                 variables_json)
 
-        self.variables = []
+        # Resolving variables which are not used by any plotted panel is wasted effort
+        referenced = set()
+        for panel in self.__panels():
+            referenced |= _variable_references(panel)
+        selected = []
         for var in variables_json:
-            self.__resolve_variable(var,
-                                    ignore_regex)
+            if var['name'] in referenced:
+                selected.append(var)
+            else:
+                _logger.debug('Dash: %s skipping unreferenced variable `%s`', self.uid, var['name'])
+
+        # Label values of several query variables can often be requested together
+        self.grafana_client.prefetch_queries([(var['query'], var['datasource'])
+                                              for var in selected if var['type'] == 'query'])
+
+        # Query variables each need a request to their datasource, resolve them concurrently
+        # so only the slowest one delays the dashboard, the order of the variables is kept
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            self.variables = list(executor.map(self.__resolve_variable,
+                                               selected))
 
-        _logger.debug(f'Dash: {self.uid} variables: {self.variables}')
+        _logger.debug('Dash: %s variables: %s', self.uid, self.variables)
+
+        # The plots only depend on the panels and variables, plan them once for all invocations
+        self.plan = self.__create_plan()
 
     def __resolve_variable(self,
-                           var: dict,
-                           ignore: str = '') -> None:
+                           var: dict) -> Variable:
         """
         Resolve the values for the selected variables via grafana
+        Values matching the ignore regex of the dashboard are left out.
 
-        :param var: The name of the variable to resolve
-        :param ignore: Regular expression matching values of the variable which shall be ignored
+        :param var: The json of the variable to resolve
+        :return: The variable with its values
         """
 
         v_type = var['type']
 
         if v_type == 'custom':
             # Custom variables have predefined and constant values, no need for special resolving
-            values = map(lambda v: v['value'],
-                         var['options'])
-            values = filter(lambda o: o != '$__all',
-                            values)
+            values = [o['value'] for o in var['options'] if o['value'] != '$__all']
         elif v_type == 'interval':
             # Intervals should be used sparingly, but they are handled anyway
-            # First the values are extracted from the array of interval objects,
-            # then unwanted multi value options are removed
-            values = map(lambda v: v['value'],
-                         var['options'])
-            values = filter(lambda o: o != '$__auto_interval_interval',
-                            values)
+            # The values are extracted from the array of interval objects without the unwanted multi value options
+            values = [o['value'] for o in var['options'] if o['value'] != '$__auto_interval_interval']
         elif v_type == 'query':
             # Query types need to be resolved by querying the respective datasource,
             # fortunately this can be done via grafana's builtin proxy
@@ -141,136 +227,347 @@ class Dashboard:
             # Abort if the variable is not known
             raise VariableError(f'Variable type `{v_type}` is currently not supported')
 
-        if ignore != '':
-            ignore = compile(ignore)
-            values = filter(lambda o: not ignore.match(o),
-                            values)
+        if self.ignore_regex is not None:
+            values = [v for v in values if not self.ignore_regex.match(v)]
 
-        self.variables.append(Variable(
+        return Variable(
             var['name'],
             list(values)
-        ))
+        )
 
     def create_plots(self,
-                     base_dir: str) -> None:
+                     base_dir: str,
+                     extra_params: dict = None) -> None:
         """
         Save all panels of this dashboard as a png plot
 
         :param base_dir: The base directory to store the plots into.
+        :param extra_params: Additional parameters passed to grafana for each plot, e.g. a different
+                             time range {'from': <ms>, 'to': <ms>} than the one of the client.
+        """
+
+        self.__render(os_path.join(base_dir, self.slug),
+                      self.plan,
+                      extra_params)
+
+    def prepare_plots(self,
+                      base_dir: str,
+                      extra_params: dict = None) -> list:
+        """
+        Prepare all plots of this dashboard to be saved with save_plot,
+        e.g. to save the plots of many dashboards with a shared executor.
+
+        :param base_dir: The base directory to store the plots into.
+        :param extra_params: Additional parameters passed to grafana for each plot, see create_plots.
+        :return: The plots in the form of (directory, params, panel)
+        """
+
+        return self.__prepare_jobs(os_path.join(base_dir, self.slug),
+                                   self.plan,
+                                   extra_params)
+
+    def save_plot(self,
+                  dir: str,
+                  params: dict,
+                  panel: dict) -> None:
+        """
+        Save a single plot prepared by prepare_plots, this can be called from any thread.
+        Failing plots are logged, unless the client aborts on errors. In that case the exception
+        is raised and the remaining plots of this dashboard are skipped.
+
+        :param dir: The directory to save the plot into
+        :param params: The parameters to request the plot with
+        :param panel: The panel json retrieved from the original dashboard json.
+        """
+
+        if self.__aborted:
+            return
+        try:
+            self.__save_png(dir, params, panel)
+        except BaseException as ex:
+            try:
+                self.__handle_plot_result(ex)
+            except BaseException:
+                self.__aborted = True
+                raise
+
+    async def create_plots_async(self,
+                                 base_dir: str,
+                                 extra_params: dict = None) -> None:
+        """
+        Save all panels of this dashboard as a png plot, requesting the plots asynchronously.
+        The grafana client must be an AsyncGrafanaClient which was entered with `async with`.
+
+        :param base_dir: The base directory to store the plots into.
+        :param extra_params: Additional parameters passed to grafana for each plot, see create_plots.
         """
 
-        _dir = os_path.join(base_dir, self.slug)
-        Path(_dir).mkdir(exist_ok=True)
+        plots = self.prepare_plots(base_dir, extra_params)
+
+        # The client bounds the outstanding requests of all dashboards
+        results = await gather(*[self.__save_png_async(*plot) for plot in plots],
+                               return_exceptions=True)
+        for result in results:
+            self.__handle_plot_result(result if isinstance(result, BaseException) else None)
+
+    def __handle_plot_result(self,
+                             ex: BaseException) -> None:
+        """
+        Handle the outcome of a single plot, so one failing plot does not abort the others
+        unless the client is configured to abort on errors.
+
+        :param ex: The exception the plot failed with or None if it succeeded
+        """
+
+        if ex is None:
+            return
+        # OSError also covers failures while streaming the png and writing it to disk
+        if isinstance(ex, (ApiError, OSError)) and not self.grafana_client.abort_on_error:
+            _logger.error(f'Dash: {self.uid} failed to create a plot: {str(ex)}, continuing with others')
+            return
+        raise ex
+
+    def __create_plan(self) -> list:
+        """
+        Collect the render jobs of all panels of this dashboard
+
+        :return: The render jobs
+        """
+
+        plan = []
+        for panel in self.__panels():
+            self.__collect_panel_jobs(plan, panel)
+
+        return plan
+
+    def __panels(self):
+        """
+        Iterate over the panels of this dashboard which are plotted
+
+        :return: Generator of the panel jsons, rows are left out, collapsed ones are
+                 replaced by their panels if they are rendered too
+        """
 
         for panel in self.json['panels']:
             if panel['type'] != 'row':
-                self.create_panel_plot(_dir, panel)
+                yield panel
             elif self.render_collapsed and panel['collapsed'] is True:
-                for collapsed_panel in panel['panels']:
-                    self.create_panel_plot(_dir, collapsed_panel)
+                yield from panel['panels']
 
     def create_panel_plot(self,
                           base_dir: str,
-                          panel: dict) -> None:
+                          panel: dict,
+                          extra_params: dict = None) -> None:
         """
         Save one single panel as a png plot
 
         :param base_dir: The base directory to store the plot into.
         :param panel: The panel json retrieved from the original dashboard json.
+        :param extra_params: Additional parameters passed to grafana for each plot, see create_plots.
+        """
+
+        jobs = []
+        self.__collect_panel_jobs(jobs, panel)
+        self.__render(base_dir, jobs, extra_params)
+
+    def __prepare_jobs(self,
+                       base_dir: str,
+                       jobs: list,
+                       extra_params: dict = None) -> list:
+        """
+        Prepare render jobs to be plotted into a directory
+
+        :param base_dir: The directory to store the plots into.
+        :param jobs: The render jobs to prepare
+        :param extra_params: Additional parameters passed to grafana for each plot
+        :return: The plots in the form of (directory, params, panel)
         """
 
-        self.current_panel = panel
-        self.__rec_create_panel_plot(base_dir, {})
+        if extra_params is None:
+            extra_params = {}
 
-    def __rec_create_panel_plot(self,
-                                dir: str,
-                                params: dict,
-                                var_index: int = 0) -> None:
+        plots = [(os_path.join(base_dir, *job.dirs), {**job.params, **extra_params}, job.panel)
+                 for job in jobs]
+
+        # Create all directories before the workers start so they do not race on it
+        self.__ensure_dir(base_dir)
+        for plot in plots:
+            self.__ensure_dir(plot[0])
+
+        return plots
+
+    def __render(self,
+                 base_dir: str,
+                 jobs: list,
+                 extra_params: dict = None) -> None:
+        """
+        Request the plots of render jobs from grafana concurrently.
+        The rendering is purely I/O bound, so a pool of threads is sufficient.
+
+        :param base_dir: The directory to store the plots into.
+        :param jobs: The render jobs to plot
+        :param extra_params: Additional parameters passed to grafana for each plot
         """
-        Recursive algorithm to save a panels plots.
+
+        plots = self.__prepare_jobs(base_dir, jobs, extra_params)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(self.__save_png, *plot) for plot in plots]
+            try:
+                for future in as_completed(futures):
+                    self.__handle_plot_result(future.exception())
+            except BaseException:
+                # Do not start any more plots if the dashboard is aborted
+                executor.shutdown(cancel_futures=True)
+                raise
+
+    def __ensure_dir(self,
+                     dir: str) -> None:
+        """
+        Create a directory including its parents if it was not already created before
+
+        :param dir: The directory to create
+        """
+
+        if dir not in self.__created_dirs:
+            Path(dir).mkdir(parents=True, exist_ok=True)
+            self.__created_dirs.add(dir)
+
+    def __used_variables(self,
+                         panel: dict) -> list:
+        """
+        Get the variables which are used in the queries of a panel
+
+        :param panel: The panel json retrieved from the original dashboard json.
+        :return: The used variables in the order of the dashboard variables
+        """
+
+        references = _variable_references(panel)
+        return [var for var in self.variables if var.name in references]
+
+    def __collect_panel_jobs(self,
+                             jobs: list,
+                             panel: dict) -> None:
+        """
+        Collect the plots of a panel.
         Each panel will be checked for which variables are used in its query
         to assure no unwanted duplicates are created (each variable value combination is queried).
 
-        :param dir: The base directory for the panel.
-                    The actual plot will be placed in subdirectories named after the variable value it is created with.
-        :param params: The params which are passed as query parameters to the grafana api.
-                       Must be in the form of var-<VARIABLE_NAME>=<VARIABLE_VALUE>.
-                       Can be empty initially.
-        :param var_index: The index o the current variable which is handled in the iteration.
-                          Should be zero in the first call.
-        """
-
-        # This method will do the following for each panel in the dashboard:
-        #   It checks the first variable in the array of passed variable for its occurrence in the panels queries
-        #   If the variable is needed, the first value is taken and the recursion goes one steep deeper to the
-        #   second variable. There again the first value is taken if needed. Variables which are not part of the panel
-        #   will be skipped. Once no more variables are left, the last one is completely iterated through.
-        #   When the last one is finished, the second last moves to the second value and again the recursion heads to
-        #   the last one to completely iterate through.
-
-        if var_index == len(self.variables):
-            # All variables have been checked if they are used for this panel,
-            # if used, values are contained in params
-            # if not, there may be none or there were no variables in the first place
-            # this is the last iteration where the snapshot is created.
-            _logger.debug(f'Dash: {self.uid} creating plot from `{self.current_panel["title"]}` with params {params}')
-            slug = slugify(self.current_panel['title'])
-            self.__save_png(name=os_path.join(dir, slug + '.png'),
-                            params=params)
-            return
+        :param jobs: The list to append the render jobs to.
+        :param panel: The panel json retrieved from the original dashboard json.
+        """
 
-        current_var = self.variables[var_index]
-        do_var = False
-
-        for target in self.current_panel['targets']:
-            if current_var.name in target['expr']:
-                # A panel can have multiple queries (targets), if one uses the variable it will be added
-                do_var = True
-                break
-
-        if do_var:
-            for val in current_var.values:
-                # Append each variable value in a recursive call to the params
-                # create a temporary _dir variable since for the current variable the parent directory should always
-                # be the same.
-                _dir = os_path.join(dir,
-                                    slugify(val))
-                Path(_dir).mkdir(exist_ok=True)
-                params[f'var-{current_var.name}'] = val
-                self.__rec_create_panel_plot(_dir,
-                                             params,
-                                             var_index + 1)
-        else:
-            # if the variable is not used the next one will be checked
-            self.__rec_create_panel_plot(dir,
-                                         params,
-                                         var_index + 1)
+        used = self.__used_variables(panel)
+
+        # Each combination of the used variables values results in one plot,
+        # without any used variables there is exactly one (empty) combination
+        for combo in product(*[list(zip(var.values, var.slugs)) for var in used]):
+            job = RenderJob(panel,
+                            {f'var-{var.name}': val for var, (val, _) in zip(used, combo)},
+                            tuple(slug for _, slug in combo))
+            _logger.debug('Dash: %s collecting plot %s', self.uid, job)
+            jobs.append(job)
+
+    def __prepare_png(self,
+                      dir: str,
+                      params: dict,
+                      panel: dict):
+        """
+        Prepare the request of a panels png plot
+
+        :param dir: The directory to save the plot into, the name is derived from the panel title
+        :param params: The parameters of the render job
+        :param panel: The panel json retrieved from the original dashboard json.
+        :return: The name of the plot, the params to request it with and its cache key
+                 or None if the plot was created from the cache already
+        """
+
+        name = os_path.join(dir, _slug(panel['title']) + '.png')
+        # Never modify the passed params, they describe the job and may be shared
+        params = {**params, 'panelId': panel['id']}
+
+        # Add a custom height for graphs and timeseries so that all legend values are added for sure
+        if panel['type'] == 'graph' or panel['type'] == 'timeseries':
+            params['height'] = self.graph_height
+            params['width'] = self.graph_width
+
+        if self.skip_existing and os_path.exists(name) and \
+                (self.max_age <= 0 or time() - os_path.getmtime(name) < self.max_age):
+            _logger.debug('Skipping existing %s', name)
+            return None
+
+        key = None
+        cache = self.grafana_client.cache
+        if cache is not None and self.grafana_client.cache_time_range:
+            key = cache.key('render', self.grafana_client.base_url, self.uid, params,
+                            self.grafana_client.default_params)
+            if cache.copy_to(key, name):
+                _logger.info('Created %s from cache', name)
+                return None
+
+        _logger.info('Creating %s', name)
+        return name, params, key
 
     def __save_png(self,
-                   name: str,
-                   params: dict = None) -> None:
+                   dir: str,
+                   params: dict,
+                   panel: dict) -> None:
         """
-        Requests the png plot of the current panel from grafana and saves it to disk
+        Requests the png plot of a panel from grafana and saves it to disk
 
-        :param name: The full path and name of the panel to save
+        :param dir: The directory to save the plot into, the name is derived from the panel title
         :param params: The parameters to pass to grafana when requesting the plot, this should be the variables
                        used in the query in form var-<VAR_NAME>=<VAR_VALUE>
+        :param panel: The panel json retrieved from the original dashboard json.
+        """
+
+        prepared = self.__prepare_png(dir, params, panel)
+        if prepared is None:
+            return
+        name, params, key = prepared
+        self.__download_png(name, params, key)
+
+    def __download_png(self,
+                       name: str,
+                       params: dict,
+                       key: str) -> None:
         """
+        Download a png plot from grafana to disk
 
-        if params is None:
-            params = {}
+        :param name: The full path and name of the plot
+        :param params: The parameters to request the plot with
+        :param key: The cache key to store the plot with or None if there is no cache
+        """
 
-        params['panelId'] = self.current_panel['id']
+        # Stream the png directly to disk, so concurrent renders do not hold whole images in memory
+        if not self.grafana_client.d_solo_render_to_file(params=params,
+                                                         dashboard_uid=self.uid,
+                                                         dashboard_slug=self.slug,
+                                                         name=name):
+            return
 
-        # Add a custom height for graphs and timeseries so that all legend values are added for sure
-        if self.current_panel['type'] == 'graph' or self.current_panel['type'] == 'timeseries':
-            params['height'] = self.graph_height
-            params['width'] = self.graph_width
+        if key is not None:
+            self.grafana_client.cache.copy_from(key, name)
+
+    async def __save_png_async(self,
+                               dir: str,
+                               params: dict,
+                               panel: dict) -> None:
+        """
+        Requests the png plot of a panel from grafana asynchronously and saves it to disk,
+        see __save_png for the parameters.
+        """
+
+        prepared = self.__prepare_png(dir, params, panel)
+        if prepared is None:
+            return
+        name, params, key = prepared
+
+        if not await self.grafana_client.d_solo_render_to_file_async(params=params,
+                                                                     dashboard_uid=self.uid,
+                                                                     dashboard_slug=self.slug,
+                                                                     name=name):
+            return
 
-        _logger.info(f'Creating {name}')
-        result = self.grafana_client.d_solo_render(params=params,
-                                                   dashboard_uid=self.uid,
-                                                   dashboard_slug=self.slug)
-        if result.ok:
-            with open(name, 'wb') as png:
-                png.write(result.content)
+        if key is not None:
+            self.grafana_client.cache.copy_from(key, name)
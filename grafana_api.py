@@ -4,16 +4,60 @@ Client implementation for the Grafana API
 @Licence: MIT
 @Author: Boss Marco <bossm8@hotmail.com>
 """
-from http.client import OK
+from concurrent.futures import Future
+from asyncio import Semaphore, sleep
+from contextlib import asynccontextmanager
+from functools import cached_property
+from http.client import OK, NOT_MODIFIED
+from json import dumps
+from importlib.util import find_spec
 from re import compile
+from shutil import copyfileobj
+from threading import Lock
 from time import time_ns
+from typing import Callable
 from urllib3 import disable_warnings
-from requests import request, Response
-from urllib3.exceptions import InsecureRequestWarning
+from urllib3.util.retry import Retry
+from requests import Session, Response, RequestException
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import InsecureRequestWarning, HTTPError, InvalidHeader
 from logging import getLogger
+from cache import ResultCache, open_atomic
+
+try:
+    # orjson decodes large dashboards and series responses considerably faster
+    from orjson import loads, dumps as _dump_bytes
+except ImportError:
+    from json import loads
+
+    def _dump_bytes(obj) -> bytes:
+        return dumps(obj).encode()
+
+try:
+    import httpx
+except ImportError:
+    # Only needed for the AsyncGrafanaClient
+    httpx = None
 
 _logger = getLogger('default')
 
+# Used with fullmatch, so no anchors are needed
+_label_values_regex = compile(
+    r'label_values\((?:(.+),\s*)?([a-zA-Z_][a-zA-Z0-9_]*)\)\s*'
+)
+
+# A plain prometheus metric name without any label matchers
+_metric_name_regex = compile(r'[a-zA-Z_:][a-zA-Z0-9_:]*')
+
+# Overloaded renderers and rate limits are retried, honouring a Retry-After header.
+# The last response is returned once retries are exhausted, it is then handled like any other failed request.
+# Used by the session of the GrafanaClient and replicated for the requests of the AsyncGrafanaClient.
+_retry = Retry(total=3,
+               backoff_factor=0.2,
+               status_forcelist=[429, 502, 503, 504],
+               respect_retry_after_header=True,
+               raise_on_status=False)
+
 
 class DataSourceError(Exception):
     pass
@@ -35,7 +79,12 @@ class GrafanaClient:
                  to_ms: int = None,
                  node_exporter_job_name: str = 'node',
                  tls_verify: bool = True,
-                 abort_on_error: bool = False):
+                 abort_on_error: bool = False,
+                 pool_maxsize: int = 32,
+                 cache: ResultCache = None,
+                 datasources_ttl: int = 600,
+                 dashboard_ttl: int = 60,
+                 cache_time_range: bool = True):
         """
         Create a grafana client.
         From and To are static, means all queries and renders are done in the time period in between those two.
@@ -50,15 +99,31 @@ class GrafanaClient:
         :param tls_verify: If the instances certificate should be verified
         :param abort_on_error: If there should be an exception when requesting a plot fails
                                If False, the next plot will be tried
+        :param pool_maxsize: How many connections to grafana are kept open for reuse,
+                             should be at least the number of concurrently requested plots
+        :param cache: Cache to store query results and plots in, so repeated runs do not need to request them again
+        :param datasources_ttl: Time in seconds the datasources are cached (if there is a cache)
+        :param dashboard_ttl: Time in seconds the dashboard jsons are cached (if there is a cache)
+        :param cache_time_range: If query results and plots, which are bound to the time range, are cached.
+                                 Those entries are never used again if the time range is not fixed.
         """
 
         self.base_url = base_url
         self.verify = tls_verify
         self.abort_on_error = abort_on_error
+        self.cache = cache
+        self.cache_time_range = cache_time_range
+        self.datasources_ttl = datasources_ttl
+        self.dashboard_ttl = dashboard_ttl
+        # Requests which are currently in progress, see coalesce()
+        self.__inflight = {}
+        self.__inflight_lock = Lock()
+        # Results of the queries executed so far, see execute_query()
+        self.__query_results = {}
         if not self.verify:
             _logger.info('Skipping certificate verification')
             disable_warnings(InsecureRequestWarning)
-        _current_time_ms = int(time_ns() // 1_000_000)
+        _current_time_ms = time_ns() // 1_000_000
         self.from_ms = from_ms if from_ms is not None else _current_time_ms - (3600 * 1000)
         self.to_ms = to_ms if to_ms is not None else _current_time_ms
         self.node_exporter_job_name = node_exporter_job_name
@@ -72,7 +137,36 @@ class GrafanaClient:
             'Authorization': 'Bearer ' + api_key,
             'Accept': 'application/json'
         }
-        self.datasources = self.__do_request('GET', '/api/datasources').json()
+        # Reuse the connections to grafana instead of doing a new handshake for each request
+        self.session = Session()
+        self.session.headers.update(self.default_headers)
+        # All requests go to the same grafana host, so a single pool holding up to pool_maxsize connections
+        # is needed. Without blocking, requests beyond pool_maxsize get a connection which is not kept afterwards.
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=pool_maxsize,
+                              pool_block=False,
+                              max_retries=_retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @cached_property
+    def datasources(self) -> list:
+        """
+        The datasources of the grafana instance, only requested when first needed
+        (rendering panels does not need them).
+        """
+
+        # Dashboards are loaded concurrently, make sure the datasources are requested only once
+        return self.coalesce(('datasources',),
+                             lambda: self.__get_json('/api/datasources', self.datasources_ttl))
+
+    @cached_property
+    def datasources_by_name(self) -> dict:
+        return {ds['name']: ds for ds in self.datasources}
+
+    @cached_property
+    def datasources_by_uid(self) -> dict:
+        return {ds['uid']: ds for ds in self.datasources}
 
     def get_datasource_json(self,
                             datasource) -> dict:
@@ -83,21 +177,66 @@ class GrafanaClient:
         :return: The datasources json representation
         """
 
-        if type(datasource) is dict:
-            for ds in self.datasources:
-                if ds['uid'] == datasource['uid']:
-                    return ds
+        try:
+            if type(datasource) is dict:
+                return self.datasources_by_uid[datasource['uid']]
+            return self.datasources_by_name[datasource]
+        except KeyError:
+            raise DataSourceError(f'Datasource `{datasource}` is not available')
+
+    def coalesce(self,
+                 key: tuple,
+                 request: Callable):
+        """
+        Deduplicate identical requests which are in progress at the same time.
+        The first caller executes the request, concurrent callers with the same key
+        wait for its result instead of requesting it again.
+
+        :param key: Hashable key identifying the request
+        :param request: Function doing the actual request
+        :return: The result of the request
+        """
+
+        with self.__inflight_lock:
+            future = self.__inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self.__inflight[key] = Future()
+
+        if not owner:
+            _logger.debug('Waiting for identical request %s in progress', key)
+            return future.result()
+
+        try:
+            result = request()
+        except BaseException as ex:
+            future.set_exception(ex)
+            raise
         else:
-            for ds in self.datasources:
-                if ds['name'] == datasource:
-                    return ds
+            future.set_result(result)
+            return result
+        finally:
+            with self.__inflight_lock:
+                del self.__inflight[key]
+
+    def warm_up(self) -> None:
+        """
+        Open a connection to grafana before requests are fanned out, after which it is kept in the pool.
+        The first concurrent requests then do not all have to connect at the same time.
+        Failures are only logged as the following requests report them anyway.
+        """
 
-        raise DataSourceError(f'Datasource `{datasource}` is not available')
+        try:
+            self.__do_request('GET', '/api/health')
+        except ApiError as ex:
+            _logger.warning(f'Could not reach grafana: {str(ex)}')
 
     def __do_request(self,
                      method: str,
                      uri: str,
-                     params: dict = None) -> Response:
+                     params: dict = None,
+                     stream: bool = False,
+                     headers: dict = None) -> Response:
         """
         Do a request to the api.
         This method will abort the program execution if there was an error.
@@ -105,26 +244,80 @@ class GrafanaClient:
         :param method: Http method of the request
         :param uri: The path of the resource to request
         :param params: The query parameters to add to the request
+        :param headers: Additional headers to send with the request
+        :param stream: If the body should not be downloaded immediately,
+                       the response must then be closed by the caller
         :return: The resulting response
         """
 
         if params is None:
             params = {}
 
-        resp = request(method=method,
-                       url=self.base_url + uri,
-                       headers=self.default_headers,
-                       params=params,
-                       verify=self.verify)
+        try:
+            # verify is passed per request on purpose, if it was only set on the session
+            # requests would let REQUESTS_CA_BUNDLE override a disabled verification
+            resp = self.session.request(method,
+                                        self.base_url + uri,
+                                        params=params,
+                                        verify=self.verify,
+                                        timeout=(5, 60),
+                                        stream=stream,
+                                        headers=headers)
+        except RequestException as ex:
+            # There is no response to continue with (e.g. grafana is unreachable even after retrying)
+            raise ApiError(f'Request for `{self.base_url + uri}` failed: {str(ex)}') from ex
 
         if not resp.ok and self.abort_on_error:
+            resp.close()
             raise ApiError(f'Request for `{resp.url}` failed with {resp.status_code} {resp.reason}, aborting dashboard')
         elif not resp.ok:
             _logger.error(f'Failed to request `{resp.url}`: {resp.status_code} {resp.reason}, continuing with others')
 
-        _logger.debug(f'Successfully requested `{resp.url}`')
+        _logger.debug('Successfully requested `%s`', resp.url)
         return resp
 
+    def __get_json(self,
+                   uri: str,
+                   ttl: int):
+        """
+        Get a json resource of the api, which is cached if there is a cache.
+        Outdated entries are revalidated with their ETag if grafana sent one.
+
+        :param uri: The path of the resource to request
+        :param ttl: Time in seconds the resource is cached
+        :return: The decoded json
+        """
+
+        if self.cache is None:
+            return loads(self.__do_request('GET', uri).content)
+
+        key = self.cache.key('json', self.base_url, uri)
+        etag_key = self.cache.key('etag', self.base_url, uri)
+        cached = self.cache.get(key, ttl)
+        if cached is not None:
+            return loads(cached)
+
+        headers = {}
+        etag = self.cache.get(etag_key, float('inf'))
+        if etag is not None:
+            headers['If-None-Match'] = etag.decode()
+
+        resp = self.__do_request('GET', uri, headers=headers)
+        if resp.status_code == NOT_MODIFIED:
+            cached = self.cache.get(key, float('inf'))
+            if cached is not None:
+                _logger.debug('Cached `%s` is still up to date', uri)
+                self.cache.touch(key)
+                return loads(cached)
+            # The entry was removed in the meantime, request it again without the ETag
+            resp = self.__do_request('GET', uri)
+
+        if resp.ok:
+            self.cache.set(key, resp.content)
+            if 'ETag' in resp.headers:
+                self.cache.set(etag_key, resp.headers['ETag'].encode())
+        return loads(resp.content)
+
     def get_dashboard_json(self,
                            uid: str):
         """
@@ -133,13 +326,14 @@ class GrafanaClient:
         :return: The json representation of the dashboard
         """
 
-        return self.__do_request('GET',
-                                 uri='/api/dashboards/uid/' + uid).json()
+        return self.__get_json('/api/dashboards/uid/' + uid,
+                               self.dashboard_ttl)
 
     def d_solo_render(self,
                       dashboard_uid: str,
                       dashboard_slug: str,
-                      params: dict = None) -> Response:
+                      params: dict = None,
+                      stream: bool = False) -> Response:
         """
         Query the render endpoint on /d-solo/ for a single panel
 
@@ -149,12 +343,61 @@ class GrafanaClient:
                        Unfortunately there is currently no available documentation of the render api but parameters
                        may include var-<VAR_NAME>=<VAR_VALUE>
                        Default added parameters are theme=light, ordId=1
+        :param stream: If the png should be streamed instead of being loaded into memory at once,
+                       the response must then be used as context manager to release the connection again
         :return: The resulting http response
         """
 
         return self.__do_request('GET',
                                  uri=f'/render/d-solo/{dashboard_uid}/{dashboard_slug}',
-                                 params=self.default_params | params)
+                                 params=self._render_params(params),
+                                 stream=stream)
+
+    def _render_params(self,
+                       params: dict = None) -> dict:
+        """
+        Get the query parameters of a render request including the default parameters
+
+        :param params: The query parameters of the panel
+        :return: The default parameters themselves if there are no others, a merged copy otherwise
+        """
+
+        # Neither requests nor httpx modify the passed parameters, so there is no need to copy the defaults
+        if not params:
+            return self.default_params
+        return {**self.default_params, **params}
+
+    def d_solo_render_to_file(self,
+                              dashboard_uid: str,
+                              dashboard_slug: str,
+                              name: str,
+                              params: dict = None) -> bool:
+        """
+        Query the render endpoint on /d-solo/ for a single panel and stream the png directly into a file,
+        without holding it in memory, see d_solo_render for details.
+
+        :param dashboard_uid: The uid of the dashboard
+        :param dashboard_slug: The slug of the dashboard
+        :param name: The full path and name of the file to save the png to
+        :param params: The query parameters to pass to the render endpoint.
+        :return: If the png was saved, False if the request failed
+        """
+
+        with self.d_solo_render(dashboard_uid=dashboard_uid,
+                                dashboard_slug=dashboard_slug,
+                                params=params,
+                                stream=True) as resp:
+            if not resp.ok:
+                return False
+            # Decode a possible content encoding (gzip) while reading the raw stream
+            resp.raw.decode_content = True
+            try:
+                with open_atomic(name) as png:
+                    copyfileobj(resp.raw, png, 64 * 1024)
+            except HTTPError as ex:
+                raise ApiError(f'Reading `{resp.url}` failed: {str(ex)}') from ex
+
+        return True
 
     def __datasource_proxy(self,
                            uri: str,
@@ -163,7 +406,7 @@ class GrafanaClient:
         Do a proxy request to the datasources in grafana.
 
         :param uri: the full query uri of the datasource (without the grafana part)
-        :param params: Query parameters to pass to the datasource
+        :param params: Query parameters to pass to the datasource, a list of tuples for repeated parameters
         :return: The resulting http response
         """
 
@@ -171,6 +414,48 @@ class GrafanaClient:
                                  f'/api/datasources/proxy/{uri}',
                                  params)
 
+    def __prom_metric(self,
+                      metric: str) -> str:
+        """
+        Prepare the metric of a label_values query to be sent to prometheus
+
+        :param metric: The metric query of the label_values query
+        :return: The metric query with the known variables replaced
+        """
+
+        if 'node' in metric:
+            # if the metric query begins with node, try to replace $job with the configured values
+            metric = metric.replace('$job', self.node_exporter_job_name)
+        return metric
+
+    def __prom_label_values_batch(self,
+                                  queries: list,
+                                  datasource_id: int) -> list:
+        """
+        Get the label values of many label_values queries with a single series request.
+        Only queries whose metric is a plain metric name can be batched, since the combined result
+        must be assigned to the queries by the metric name of each series.
+
+        :param queries: The queries in the form of (metric, label)
+        :param datasource_id: The prometheus datasource which to query
+        :return: The label values of each query in the same order or None if the request failed
+        """
+
+        params = [('match[]', metric) for metric in dict.fromkeys(metric for metric, _ in queries)]
+        # Prometheus uses seconds
+        params += [('start', self.from_ms // 1000),
+                   ('end', self.to_ms // 1000)]
+        resp = self.__datasource_proxy(f'{datasource_id}/api/v1/series', params)
+        if not resp.ok:
+            return None
+
+        series = loads(resp.content)['data']
+        results = []
+        for metric, label in queries:
+            results.append(list({value for m in series
+                                 if m.get('__name__') == metric and (value := m.get(label)) and value != '$__all'}))
+        return results
+
     def __prom_label_values(self,
                             metric: str,
                             label: str,
@@ -187,23 +472,19 @@ class GrafanaClient:
         if metric == '':
             # There is no metric so just query this must be a directly reachable label
             result = self.__datasource_proxy(f'{datasource_id}/api/v1/label/{label}/values')
-            result = result.json()['data']
+            result = loads(result.content)['data']
         else:
             # Send the metric query to prometheus
-            if 'node' in metric:
-                # if the metric query begins with node, try to replace $job with the configured values
-                metric = metric.replace('$job', self.node_exporter_job_name)
+            metric = self.__prom_metric(metric)
             params = {
                 'match[]': metric,
                 # Prometheus uses seconds
-                'start': int(self.from_ms / 1000),
-                'end': int(self.to_ms / 1000),
+                'start': self.from_ms // 1000,
+                'end': self.to_ms // 1000,
             }
-            result = self.__datasource_proxy(f'{datasource_id}/api/v1/series', params).json()
+            result = loads(self.__datasource_proxy(f'{datasource_id}/api/v1/series', params).content)
             # Extract the required values from the json and filter out unwanted multi value options
-            result = map(lambda m: m.get(label, ''), result['data'])
-            result = filter(lambda v: v != '$__all' and v != '', result)
-            result = list(set(result))
+            result = list({value for m in result['data'] if (value := m.get(label)) and value != '$__all'})
 
         return result
 
@@ -218,12 +499,9 @@ class GrafanaClient:
         :return: The processed result (e.g. for label_values a list)
         """
 
-        label_values_regex = compile(
-            '^label_values\((?:(.+),\s*)?([a-zA-Z_][a-zA-Z0-9_]*)\)\s*$'
-        )
-        if label_values_regex.match(query['query']):
-            result = label_values_regex.findall(query['query'])
-            metric, label = result[0]
+        match = _label_values_regex.fullmatch(query['query'])
+        if match:
+            metric, label = match.group(1) or '', match.group(2)
             return self.__prom_label_values(metric, label, datasource['id'])
 
     def execute_query(self,
@@ -238,9 +516,302 @@ class GrafanaClient:
         """
 
         ds = self.get_datasource_json(datasource)
+
+        # Variables of many dashboards often use the very same query, the from and to are the same
+        # for the whole client, so each query is only executed once per run
+        key = self.__query_key(query, ds)
+        if key not in self.__query_results:
+            self.__query_results[key] = self.coalesce(key,
+                                                      lambda: self.__execute_cached_query(query, ds))
+        return self.__query_results[key]
+
+    def __query_key(self,
+                    query: dict,
+                    ds: dict) -> tuple:
+        """
+        Key of a query for the in-flight requests and the results of this run
+
+        :param query: The json query extracted from the dashboard
+        :param ds: The json of the datasource the query is executed against
+        :return: The hashable key
+        """
+
+        return 'query', ds['name'], dumps(query, sort_keys=True)
+
+    def __query_cache_key(self,
+                          query: dict,
+                          ds: dict) -> str:
+        """
+        Key of a query result in the cache, which may be shared between grafana instances
+
+        :param query: The json query extracted from the dashboard
+        :param ds: The json of the datasource the query is executed against
+        :return: The cache key
+        """
+
+        return self.cache.key('query', self.base_url, ds['name'], query, self.from_ms, self.to_ms)
+
+    def prefetch_queries(self,
+                         queries: list) -> None:
+        """
+        Execute many queries at once where possible, so that subsequent calls to execute_query
+        for them do not need any more requests.
+        Currently prometheus label_values queries of plain metric names on the same datasource
+        are combined into a single series request, all other queries are left to execute_query.
+
+        :param queries: The queries in the form of (query, datasource), see execute_query
+        """
+
+        batches = {}
+        for query, datasource in queries:
+            try:
+                ds = self.get_datasource_json(datasource)
+            except DataSourceError:
+                # Reported once the query is executed
+                continue
+            if ds['type'] != 'prometheus':
+                continue
+
+            key = self.__query_key(query, ds)
+            if key in self.__query_results:
+                continue
+            if self.cache is not None and self.cache_time_range:
+                cached = self.cache.get(self.__query_cache_key(query, ds))
+                if cached is not None:
+                    self.__query_results[key] = loads(cached)
+                    continue
+
+            match = _label_values_regex.fullmatch(query['query'])
+            if match and match.group(1) is not None:
+                metric = self.__prom_metric(match.group(1))
+                if _metric_name_regex.fullmatch(metric):
+                    batches.setdefault(ds['id'], []).append((key, query, ds, metric, match.group(2)))
+
+        for datasource_id, batch in batches.items():
+            if len(batch) < 2:
+                continue
+            _logger.debug('Requesting %d label_values queries of datasource %s at once', len(batch), datasource_id)
+            results = self.__prom_label_values_batch([(metric, label) for _, _, _, metric, label in batch],
+                                                     datasource_id)
+            if results is None:
+                continue
+            for (key, query, ds, _, _), result in zip(batch, results):
+                self.__query_results[key] = result
+                if self.cache is not None and self.cache_time_range:
+                    self.cache.set(self.__query_cache_key(query, ds), _dump_bytes(result))
+
+    def __execute_cached_query(self,
+                               query: dict,
+                               ds: dict):
+        """
+        Execute a query on a datasource via grafana, using the cache if there is one
+
+        :param query: The json query extracted from the dashboard
+        :param ds: The json of the datasource to execute the query against
+        :return: The processed result data of the query (e.g. a list for label_values)
+        """
+
+        if self.cache is not None and self.cache_time_range:
+            key = self.__query_cache_key(query, ds)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return loads(cached)
+            result = self.__execute_query(query, ds)
+            if result is not None:
+                self.cache.set(key, _dump_bytes(result))
+            return result
+
+        return self.__execute_query(query, ds)
+
+    def __execute_query(self,
+                        query: dict,
+                        ds: dict):
+        """
+        Execute a query on a datasource via grafana without consulting the cache
+
+        :param query: The json query extracted from the dashboard
+        :param ds: The json of the datasource to execute the query against
+        :return: The processed result data of the query (e.g. a list for label_values)
+        """
+
         if ds['type'] == "prometheus":
             return self.query_prometheus(query, ds)
         elif ds['type'] == "loki":
             raise DataSourceError('Loki queries not implemented yet')
         else:
             raise DataSourceError(f'Unsupported datasource type `{ds["type"]}`')
+
+
+class AsyncGrafanaClient(GrafanaClient):
+    """
+    Grafana API client which additionally requests plots asynchronously.
+
+    All other requests (dashboards, datasources and queries) are done with the synchronous client.
+    The plots are requested with httpx, which multiplexes them over a single HTTP/2 connection
+    instead of needing one HTTP/1.1 connection per concurrent plot.
+    The client must be entered with `async with` before requesting plots asynchronously.
+    """
+
+    def __init__(self,
+                 *args,
+                 max_connections: int = 64,
+                 http2: bool = True,
+                 concurrency: int = 8,
+                 **kwargs):
+        """
+        Create an asynchronous grafana client, see GrafanaClient for the remaining arguments.
+
+        :param max_connections: The maximum number of connections opened to grafana for plots
+        :param concurrency: How many plots are requested at the same time, over all dashboards
+                            (HTTP/2 multiplexes them, so the connections do not limit this)
+        :param http2: If plots should be requested over HTTP/2 (requires httpx[http2])
+        """
+
+        if httpx is None:
+            raise ImportError('The async client requires httpx, install it with `pip install httpx[http2]`')
+
+        super().__init__(*args, **kwargs)
+        self.max_connections = max_connections
+        self.http2 = http2
+        self.concurrency = concurrency
+        if self.http2 and find_spec('h2') is None:
+            _logger.warning('HTTP/2 requires `pip install httpx[http2]`, requesting plots over HTTP/1.1')
+            self.http2 = False
+        self.async_session = None
+        self.render_semaphore = None
+
+    async def __aenter__(self):
+        # Waiting for a free connection is bounded by the plot concurrency, so there is no pool timeout
+        self.async_session = httpx.AsyncClient(headers=self.default_headers,
+                                               verify=self.verify,
+                                               http2=self.http2,
+                                               timeout=httpx.Timeout(60, connect=5, pool=None),
+                                               limits=httpx.Limits(max_connections=self.max_connections,
+                                                                   max_keepalive_connections=16))
+        # Shared by all dashboards so grafana's renderer is not overloaded
+        self.render_semaphore = Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.async_session.aclose()
+        self.async_session = None
+        self.render_semaphore = None
+
+    @asynccontextmanager
+    async def __do_request_async(self,
+                                 method: str,
+                                 uri: str,
+                                 params: dict = None):
+        """
+        Do a streamed request to the api asynchronously, to be used as async context manager.
+
+        :param method: Http method of the request
+        :param uri: The path of the resource to request
+        :param params: The query parameters to add to the request
+        :return: The resulting response, the body is not yet downloaded
+        """
+
+        if params is None:
+            params = {}
+
+        resp = await self.__send_with_retries(method, uri, params)
+        try:
+            if not resp.is_success and self.abort_on_error:
+                raise ApiError(f'Request for `{resp.url}` failed with {resp.status_code} {resp.reason_phrase}, '
+                               f'aborting dashboard')
+            elif not resp.is_success:
+                _logger.error(f'Failed to request `{resp.url}`: {resp.status_code} {resp.reason_phrase}, '
+                              f'continuing with others')
+
+            _logger.debug('Successfully requested `%s`', resp.url)
+            yield resp
+        except httpx.HTTPError as ex:
+            raise ApiError(f'Request for `{resp.url}` failed: {str(ex)}') from ex
+        finally:
+            await resp.aclose()
+
+    async def __send_with_retries(self,
+                                  method: str,
+                                  uri: str,
+                                  params: dict) -> 'httpx.Response':
+        """
+        Send a streamed request, retrying failed connections and retryable status codes
+        the same way the session of the synchronous client does (see _retry).
+
+        :param method: Http method of the request
+        :param uri: The path of the resource to request
+        :param params: The query parameters to add to the request
+        :return: The response of the last attempt, the body is not yet downloaded
+        """
+
+        for attempt in range(_retry.total + 1):
+            delay = _retry.backoff_factor * (2 ** attempt)
+            try:
+                resp = await self.async_session.send(self.async_session.build_request(method,
+                                                                                       self.base_url + uri,
+                                                                                       params=params),
+                                                     stream=True)
+            except httpx.TransportError as ex:
+                if attempt == _retry.total:
+                    raise ApiError(f'Request for `{self.base_url + uri}` failed: {str(ex)}') from ex
+            else:
+                if attempt == _retry.total or resp.status_code not in _retry.status_forcelist:
+                    return resp
+                await resp.aclose()
+                if 'Retry-After' in resp.headers:
+                    try:
+                        delay = _retry.parse_retry_after(resp.headers['Retry-After'])
+                    except InvalidHeader:
+                        pass
+            _logger.debug('Retrying `%s` in %.1fs', self.base_url + uri, delay)
+            await sleep(delay)
+
+    @asynccontextmanager
+    async def d_solo_render_async(self,
+                                  dashboard_uid: str,
+                                  dashboard_slug: str,
+                                  params: dict = None):
+        """
+        Query the render endpoint on /d-solo/ for a single panel asynchronously,
+        to be used as async context manager, see d_solo_render for details.
+        At most `concurrency` plots are requested at the same time.
+
+        :param dashboard_uid: The uid of the dashboard
+        :param dashboard_slug: The slug of the dashboard
+        :param params: The query parameters to pass to the render endpoint.
+        :return: The resulting streamed http response
+        """
+
+        # The render is only done once its response was read, so the slot is held until then
+        async with self.render_semaphore:
+            async with self.__do_request_async('GET',
+                                               uri=f'/render/d-solo/{dashboard_uid}/{dashboard_slug}',
+                                               params=self._render_params(params)) as resp:
+                yield resp
+
+    async def d_solo_render_to_file_async(self,
+                                          dashboard_uid: str,
+                                          dashboard_slug: str,
+                                          name: str,
+                                          params: dict = None) -> bool:
+        """
+        Query the render endpoint on /d-solo/ for a single panel asynchronously and stream the png to a file,
+        see d_solo_render_to_file for details.
+
+        :param dashboard_uid: The uid of the dashboard
+        :param dashboard_slug: The slug of the dashboard
+        :param name: The full path and name of the file to save the png to
+        :param params: The query parameters to pass to the render endpoint.
+        :return: If the png was saved, False if the request failed
+        """
+
+        async with self.d_solo_render_async(dashboard_uid=dashboard_uid,
+                                            dashboard_slug=dashboard_slug,
+                                            params=params) as resp:
+            if not resp.is_success:
+                return False
+            with open_atomic(name) as png:
+                async for chunk in resp.aiter_bytes(chunk_size=64 * 1024):
+                    png.write(chunk)
+
+        return True
@@ -7,44 +7,86 @@ Grafana Dashboard plotter entrypoint
 @Author: Boss Marco <bossm8@hotmail.com>
 """
 from os import path as os_path
-from time import time, strftime, localtime
+from time import time_ns, strftime, localtime
 from argparse import ArgumentParser
-from multiprocessing import Pool, cpu_count
-from grafana_api import GrafanaClient, ApiError, DataSourceError
+from asyncio import gather, to_thread, run as asyncio_run
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+from grafana_api import GrafanaClient, AsyncGrafanaClient, ApiError, DataSourceError
+from cache import ResultCache, DEFAULT_CACHE_DIR
 from dashboard import Dashboard, VariableError
 from pathlib import Path
-from yaml import safe_load, YAMLError
+from functools import lru_cache, partial
+from yaml import load, YAMLError
 from logging import getLogger, StreamHandler, Formatter
 from sys import stdout
 
+try:
+    # The libyaml based loader is considerably faster if available
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 _logger = getLogger('default')
 _handler = StreamHandler(stdout)
 _handler.setFormatter(Formatter('%(levelname)s: %(message)s'))
 _logger.addHandler(_handler)
 
-with open("config.yaml", "r") as config:
-    try:
-        _cfg = safe_load(config)
-    except YAMLError as e:
-        print("ERROR: Could not parse yaml configuration file")
-        print(e)
-        exit(1)
 
-_grafana_client: GrafanaClient
+@lru_cache(maxsize=None)
+def _parse_config(name: str,
+                   mtime: float) -> dict:
+    """
+    Parse a yaml configuration file, cached as long as the file is not modified.
+
+    :param name: The path of the configuration file
+    :param mtime: The modification time of the file, only used as part of the cache key
+    :return: The parsed configuration
+    """
+
+    with open(name, "r") as config:
+        return load(config, Loader=SafeLoader)
+
+
+def load_config(name: str = "config.yaml") -> dict:
+    """
+    Load the yaml configuration file, it is only parsed again if it was modified.
+
+    :param name: The path of the configuration file
+    :return: The parsed configuration
+    """
+
+    return _parse_config(name, os_path.getmtime(name))
+
+
+try:
+    _cfg = load_config()
+except YAMLError as e:
+    print("ERROR: Could not parse yaml configuration file")
+    print(e)
+    exit(1)
 
 _output_dir = os_path.join(
     Path(__file__).parent.resolve(),
     _cfg.get('plots', {'output_dir': 'plots'}).get('output_dir')
 )
 
+_concurrency = int(_cfg.get('plots', {}).get('concurrency', 8))
+
+_skip_existing = str(_cfg.get('plots', {}).get('skip_existing', 'false')).lower() in ['true', '1']
+_max_age = int(_cfg.get('plots', {}).get('max_age', 0))
+
 _logger.setLevel(str(_cfg.get('log_level', 'info')).upper())
 
 
-def plot_dashboard(dash_config: dict):
+def create_dashboard(grafana_client: GrafanaClient,
+                     dash_config: dict) -> Dashboard:
     """
-    Plot all panels of one dashboard.
+    Create a dashboard from its configuration, this resolves its variables.
 
+    :param grafana_client: The client connected to the grafana instance
     :param dash_config: The configuration of the dashboard read from config.yaml
+    :return: The dashboard ready to be plotted
     """
 
     if 'variables' not in dash_config:
@@ -58,14 +100,29 @@ def plot_dashboard(dash_config: dict):
     width = graph_config.get('width', 1200)
     height = graph_config.get('height', 500)
 
+    return Dashboard(grafana_client,
+                     dash_config['uid'],
+                     width,
+                     height,
+                     dash_config['variables'],
+                     dash_config['ignore'],
+                     dash_config['collapsed'],
+                     concurrency=_concurrency,
+                     skip_existing=_skip_existing,
+                     max_age=_max_age)
+
+
+def plot_dashboard(grafana_client: GrafanaClient,
+                   dash_config: dict):
+    """
+    Plot all panels of one dashboard.
+
+    :param grafana_client: The client connected to the grafana instance
+    :param dash_config: The configuration of the dashboard read from config.yaml
+    """
+
     try:
-        dashboard = Dashboard(_grafana_client,
-                              dash_config['uid'],
-                              width,
-                              height,
-                              dash_config['variables'],
-                              dash_config['ignore'],
-                              dash_config['collapsed'])
+        dashboard = create_dashboard(grafana_client, dash_config)
         dashboard.create_plots(_output_dir)
     except (VariableError, DataSourceError, ApiError) as ex:
         _logger.error(f'Dashboard {dash_config["uid"]} failed with exception:\n {str(ex)}')
@@ -73,32 +130,131 @@ def plot_dashboard(dash_config: dict):
         _logger.info(f'Dashboard {dash_config["uid"]} finished')
 
 
-def run(sequential: bool = False):
+async def plot_dashboard_async(grafana_client: AsyncGrafanaClient,
+                               dash_config: dict):
+    """
+    Plot all panels of one dashboard, requesting the plots asynchronously.
+
+    :param grafana_client: The entered asynchronous client connected to the grafana instance
+    :param dash_config: The configuration of the dashboard read from config.yaml
+    """
+
+    try:
+        # Loading the dashboard and resolving its variables is done synchronously, keep it off the event loop
+        dashboard = await to_thread(create_dashboard, grafana_client, dash_config)
+        await dashboard.create_plots_async(_output_dir)
+    except (VariableError, DataSourceError, ApiError, OSError) as ex:
+        _logger.error(f'Dashboard {dash_config["uid"]} failed with exception:\n {str(ex)}')
+    finally:
+        _logger.info(f'Dashboard {dash_config["uid"]} finished')
+
+
+async def run_async(grafana_client: AsyncGrafanaClient,
+                    dashboards_c: list):
+    """
+    Plot all dashboards concurrently in a single event loop,
+    the plots of all dashboards share the connections of the client.
+
+    :param grafana_client: The asynchronous client connected to the grafana instance
+    :param dashboards_c: The configuration of the dashboards read from config.yaml
+    """
+
+    async with grafana_client:
+        await gather(*[plot_dashboard_async(grafana_client, dash) for dash in dashboards_c])
+
+
+def load_dashboard(grafana_client: GrafanaClient,
+                   dash_config: dict):
+    """
+    Load one dashboard, logging if it fails.
+
+    :param grafana_client: The client connected to the grafana instance
+    :param dash_config: The configuration of the dashboard read from config.yaml
+    :return: The dashboard or None if it could not be loaded
+    """
+
+    try:
+        return create_dashboard(grafana_client, dash_config)
+    except (VariableError, DataSourceError, ApiError) as ex:
+        _logger.error(f'Dashboard {dash_config["uid"]} failed with exception:\n {str(ex)}')
+        return None
+
+
+def plot_dashboards(grafana_client: GrafanaClient,
+                    dashboards_c: list):
+    """
+    Plot all dashboards with a single executor for the plots of all dashboards,
+    so a large dashboard does not keep rendering serially while others are done already.
+    Threads share the client, so all plots reuse its connections.
+
+    :param grafana_client: The client connected to the grafana instance
+    :param dashboards_c: The configuration of the dashboards read from config.yaml
+    """
+
+    # Loading the dashboards resolves their variables, which is done concurrently too
+    with ThreadPoolExecutor(max_workers=min(32, 4 * cpu_count())) as executor:
+        dashboards = [dash for dash in executor.map(partial(load_dashboard, grafana_client), dashboards_c)
+                      if dash is not None]
+
+    with ThreadPoolExecutor(max_workers=_concurrency) as executor:
+        futures = {}
+        for dashboard in dashboards:
+            try:
+                # Preparing creates the output directories of the dashboard
+                plots = dashboard.prepare_plots(_output_dir)
+            except (ApiError, OSError) as ex:
+                _logger.error(f'Dashboard {dashboard.uid} failed with exception:\n {str(ex)}')
+                _logger.info(f'Dashboard {dashboard.uid} finished')
+                continue
+            futures[dashboard] = [executor.submit(dashboard.save_plot, *plot) for plot in plots]
+
+        for dashboard, dash_futures in futures.items():
+            for future in dash_futures:
+                try:
+                    future.result()
+                except (ApiError, OSError) as ex:
+                    # Skip the remaining plots of the dashboard which did not start yet,
+                    # plots which are already being requested are still finished
+                    for pending in dash_futures:
+                        pending.cancel()
+                    _logger.error(f'Dashboard {dashboard.uid} failed with exception:\n {str(ex)}')
+                    break
+            _logger.info(f'Dashboard {dashboard.uid} finished')
+
+
+def run(grafana_client: GrafanaClient,
+        sequential: bool = False,
+        asynchronous: bool = False):
     """
     Run the program to create plots of each dashboards panels.
 
+    :param grafana_client: The client connected to the grafana instance
     :param sequential: If the dashboards should be handled sequentially rather than concurrently
+    :param asynchronous: If the plots should be requested asynchronously (requires an AsyncGrafanaClient)
     """
 
     Path(_output_dir).mkdir(exist_ok=True)
 
     dashboards_c = _cfg.get('dashboards')
 
+    grafana_client.warm_up()
+
     if sequential:
         _logger.info('Handling dashboards sequentially')
         for dash in dashboards_c:
-            plot_dashboard(dash)
+            plot_dashboard(grafana_client, dash)
+    elif asynchronous:
+        _logger.info('Requesting plots asynchronously')
+        asyncio_run(run_async(grafana_client, dashboards_c))
     else:
-        pool = Pool(cpu_count())
-        pool.map(plot_dashboard, dashboards_c)
-        pool.close()
-        pool.join()
+        plot_dashboards(grafana_client, dashboards_c)
 
     _logger.info('Plotting finished')
 
 
 def main():
-    current_time_s = time()
+    # Integer seconds, so the defaults have the same type as timestamps passed on the command line
+    current_time_s = time_ns() // 1_000_000_000
     cfg_from_s = _cfg.get('grafana').get('default_time_range', 3600)
 
     parser = ArgumentParser(description="Plot Grafana Dashboard Panels to png")
@@ -106,36 +262,80 @@ def main():
                         help='The start of the time slice (unix timestamp) in which plots are created. '
                              'If not specified, the default from config.yaml or now-1h is used.',
                         dest='from_s',
-                        default=current_time_s - cfg_from_s,
                         type=int)
     parser.add_argument('-t', '--to',
                         help='The end of the time slice (unix timestamp) which plots are created, defaults to now',
                         dest='to_s',
-                        default=current_time_s,
                         type=int)
     parser.add_argument('-s', '--sequentially',
                         help='If dashboards should be handled in sequence rather than concurrently',
                         dest='seq',
                         action='store_true')
+    parser.add_argument('-a', '--async',
+                        help='Request the plots of all dashboards asynchronously from one event loop over HTTP/2 '
+                             '(requires httpx[http2]), overrides grafana.async in config.yaml',
+                        dest='asynchronous',
+                        action='store_true')
+    parser.add_argument('-i', '--incremental',
+                        help='Skip plots which already exist in the output directory (see plots.max_age in config.yaml)',
+                        dest='incremental',
+                        action='store_true')
+    parser.add_argument('--force',
+                        help='Recreate all plots, even if plots.skip_existing is set in config.yaml',
+                        dest='force',
+                        action='store_true')
 
     args = vars(parser.parse_args())
 
-    global _grafana_client
-    _grafana_client = GrafanaClient(
+    # Results bound to a time range relative to now would never be used again
+    fixed_time_range = args['from_s'] is not None and args['to_s'] is not None
+    if args['from_s'] is None:
+        args['from_s'] = current_time_s - cfg_from_s
+    if args['to_s'] is None:
+        args['to_s'] = current_time_s
+
+    global _skip_existing
+    _skip_existing = (_skip_existing or args['incremental']) and not args['force']
+
+    cache_config = _cfg.get('cache', {})
+    cache = None
+    if str(cache_config.get('enabled', 'false')).lower() in ['true', '1']:
+        cache = ResultCache(directory=os_path.expanduser(cache_config.get('directory', DEFAULT_CACHE_DIR)),
+                            ttl=int(cache_config.get('ttl', 600)),
+                            max_age=int(cache_config.get('max_age', 86400)))
+
+    asynchronous = args['asynchronous'] or \
+        str(_cfg.get('grafana').get('async', 'false')).lower() in ['true', '1']
+
+    client_kwargs = {}
+    if asynchronous:
+        client_kwargs['http2'] = str(_cfg.get('grafana').get('http2', 'true')).lower() in ['true', '1']
+        client_kwargs['max_connections'] = _concurrency
+        client_kwargs['concurrency'] = _concurrency
+
+    grafana_client = (AsyncGrafanaClient if asynchronous else GrafanaClient)(
         base_url=_cfg.get('grafana').get('base_url'),
         api_key=_cfg.get('grafana').get('admin_api_key'),
         from_ms=args['from_s'] * 1000,
         to_ms=args['to_s'] * 1000,
         node_exporter_job_name=_cfg.get('prometheus', {'node_exporter_job_name': 'node'}).get('node_exporter_job_name'),
         tls_verify=True if str(_cfg.get('grafana').get('tls_verify', 'true')).lower() in ['true', '1'] else False,
-        abort_on_error=True if str(_cfg.get('grafana').get('abort_on_api_error', 'false')).lower() in ['true', '1'] else False
+        abort_on_error=True if str(_cfg.get('grafana').get('abort_on_api_error', 'false')).lower() in ['true', '1'] else False,
+        pool_maxsize=_concurrency,
+        cache=cache,
+        datasources_ttl=int(cache_config.get('datasources_ttl', 600)),
+        dashboard_ttl=int(cache_config.get('dashboard_ttl', 60)),
+        cache_time_range=fixed_time_range,
+        **client_kwargs
     )
 
     _logger.info('Creating plots between {} and {}'.format(
         strftime('%X %x', localtime(args['from_s'])),
         strftime('%X %x', localtime(args['to_s']))
     ))
-    run(sequential=args['seq'])
+    run(grafana_client,
+        sequential=args['seq'],
+        asynchronous=asynchronous)
 
 
 if __name__ == "__main__":
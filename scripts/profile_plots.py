@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""
+Profile a sequential run of the plotter and check that it is bound by network I/O
+
+Creating the plots is almost entirely waiting on grafana (and its renderer), there is no numeric
+inner loop which would profit from Numba or Cython. This script is meant to back changes to
+the hot path with numbers: it fails if less than the given share of the profiled time is spent
+in socket / ssl calls, which would mean that there is CPU work worth looking at.
+
+Run it from the directory containing config.yaml, all further arguments are passed to plots.py:
+
+    python scripts/profile_plots.py [--threshold 0.8] [--top 25] [-f <from>] [-t <to>]
+
+@Licence: MIT
+@Author: Boss Marco <bossm8@hotmail.com>
+"""
+
+import sys
+from argparse import ArgumentParser
+from cProfile import Profile
+from os import path as os_path
+from pstats import Stats
+from threading import Thread
+
+sys.path.insert(0, os_path.dirname(os_path.dirname(os_path.abspath(__file__))))
+
+# Calls which wait for the network
+_io_modules = ('_socket.', '_ssl.', 'select.')
+# Calls which wait for other threads, they are left out of the total as the waited for work is profiled itself
+_wait_calls = ("<method 'acquire' of '_thread.lock' objects>",
+               "<method 'acquire' of '_thread.RLock' objects>",
+               "<method 'get' of '_queue.SimpleQueue' objects>")
+
+_profiles = []
+_thread_run = Thread.run
+
+
+def _profiled_thread_run(self):
+    """
+    Profile each thread on its own, cProfile only sees the thread it was enabled in
+    while the plots are requested by worker threads.
+    """
+
+    profile = Profile()
+    _profiles.append(profile)
+    profile.runcall(_thread_run, self)
+
+
+def io_share(stats: Stats) -> float:
+    """
+    Calculate the share of the time spent waiting for the network
+
+    :param stats: The profiling statistics of all threads
+    :return: The share of the time spent in socket / ssl calls (0-1)
+    """
+
+    io_time = wait_time = total_time = 0.0
+    for (filename, _, function), (_, _, own_time, _, _) in stats.stats.items():
+        total_time += own_time
+        if filename == '~' and any(module in function for module in _io_modules):
+            io_time += own_time
+        elif filename == '~' and function in _wait_calls:
+            wait_time += own_time
+
+    busy_time = total_time - wait_time
+    return io_time / busy_time if busy_time > 0 else 0.0
+
+
+def main():
+    parser = ArgumentParser(description='Profile a sequential run of plots.py (remaining arguments are passed on)')
+    parser.add_argument('--threshold',
+                        help='The share of time (0-1) which must be spent in socket / ssl calls, defaults to 0.8',
+                        type=float,
+                        default=0.8)
+    parser.add_argument('--top',
+                        help='How many functions to print sorted by their own time, defaults to 25',
+                        type=int,
+                        default=25)
+    args, plots_args = parser.parse_known_args()
+
+    # plots.py reads config.yaml on import, which is why it is not imported at the top
+    sys.argv = ['plots.py', '--sequentially', *plots_args]
+    import plots
+
+    Thread.run = _profiled_thread_run
+    profile = Profile()
+    try:
+        profile.runcall(plots.main)
+    finally:
+        Thread.run = _thread_run
+
+    stats = Stats(profile)
+    for thread_profile in _profiles:
+        stats.add(thread_profile)
+    stats.sort_stats('tottime').print_stats(args.top)
+
+    share = io_share(stats)
+    print(f'{share:.1%} of the time (without waiting for other threads) was spent in socket / ssl calls')
+    if share < args.threshold:
+        print(f'ERROR: Expected at least {args.threshold:.0%}, look for CPU work on the hot path')
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()